@@ -30,6 +30,28 @@
 #	basis.  Woe unto those who choose not to do so as duplication in your ticket managing software
 #	is the possible ramification if you do not.
 #
+#	Retention:  Left alone the sqlite database grows forever.  Run the script with --compact on an intermittent basis
+#	(cron works fine) to move every thread whose newest message is older than the retention period into a separate
+#	archive sqlite file.  The hot file keeps a small bloom filter of what was archived so we only open the archive
+#	when reddit hands us an old thread again.  Back up the archive file too - it is every bit as important.
+#
+#	Multiple workers:  Running two plain copies against the same sqlite database WILL create duplicate tickets.  If you
+#	want more than one copy (more cores, or a hot spare) turn on workerModeEnabled.  Root threads are split into
+#	partitions and each copy leases partitions in the sqlite database, only touching threads in partitions it holds.
+#	If a copy dies its leases expire and the survivors pick them up.
+#
+#	Profiling:  If cycles get slow, --profile-cycles N profiles every Nth processing cycle and --profile-sampling keeps a
+#	cheap stack sampler running that logs the hottest functions every so often.  Both write into a folder next to the
+#	log file.  See the Profiling Information section below.
+#
+#	Shadow mode:  To see how a new release copes with your real modmail volume without touching anything, run with
+#	--shadow.  It reads modmail (and request tracker) for real, but every ticket/reddit write is only recorded, and it
+#	works on a scratch copy of the sqlite database.  Each cycle it reports the writes it would have made, their rate,
+#	and how long each stage took.  --record-listing saves a real cycles modmail listing to a file and --replay-listing
+#	plays it back later (--replay-speed to go faster) in shadow mode.  Both run as an extended validation pass.  Pair
+#	--replay-listing with --shadow-fresh-state, otherwise the copied database already has those threads and there is
+#	little left to measure.
+#
 #	It has not been tested what happens if you get a modmail update to something you mark DELETED
 #	in the ticket management software, but since this deletion is soft deletion and not hard
 #	it is expected that it will still be fine.
@@ -65,6 +87,33 @@ redditAbsoluteOldestModmailRootNodeDateToConsider = 1420070400 # Epoch Notation
 # SqlLite Information
 sqliteDatabaseFilename = 'ModMailTicketManager.sqlite' # If this doesnt exist, it creates.
 sqliteDatabaseTablename = 'HandledTickets' # TableName you wish to use for handled tickets.  We will create it.
+# Retention - used by --compact.  Threads whose newest message is older than this many days get moved to the archive file.
+#	This is never allowed to be shorter than redditMaximumAmountOfDaysToAllowLookbackForMissingReplies, we will use that instead.
+sqliteArchiveDatabaseFilename = 'ModMailTicketManager.archive.sqlite' # If this doesnt exist, it creates.
+sqliteArchiveThreadsOlderThanDays = 30
+sqliteArchiveBloomFilterFalsePositiveRate = 0.01 # Chance that a hot lookup miss needlessly checks the archive file.
+
+# Multi-worker Information
+# Only turn this on if you run more than one copy against the same sqliteDatabaseFilename.  Each copy needs a unique --worker-id
+#	(defaults to hostname:pid).  Leases live in the sqlite database, so every copy must see it on a local disk - sqlite locking
+#	over network shares is not trustworthy and you will get duplicates.
+workerModeEnabled = False
+workerPartitionCount = 16 # Root threads are split by id into this many partitions.  Should be >= the number of workers you run.
+workerLeaseDurationInSeconds = 300 # A dead workers partitions are picked up after this long.  Keep well above redditSleepIntervalInSecondsBetweenRequests.
+
+# Profiling Information
+# --profile-cycles N runs every Nth processing cycle under cProfile plus a fine-grained stack sampler.  Each profiled cycle writes
+#	a .prof dump (open with pstats or snakeviz) and a .collapsed file (one 'stack count' per line, feed it to flamegraph.pl).
+# --profile-sampling keeps a coarse stack sampler on all the time.  It only samples while a cycle is running (not while we sleep)
+#	and every profileSamplingReportIntervalInMinutes logs the hottest functions and writes a .collapsed file.  Cheap enough for production.
+# Files go into profileDirectoryName next to the log file (current directory if there is no log file).  Oldest files get removed
+#	once there are more than profileMaximumFilesToKeep.
+profileDirectoryName = 'profiles'
+profileMaximumFilesToKeep = 100
+profileCycleSamplingIntervalInMilliseconds = 5
+profileSamplingIntervalInMilliseconds = 100
+profileSamplingReportIntervalInMinutes = 15
+profileNumberOfHotFunctionsToReport = 15
 
 # Request Tracker
 requestTrackerRestApiUrl = 'http://192.168.25.129/rt/REST/1.0/' # Pretty much your url + /Rest/1.0/
@@ -123,20 +172,56 @@ resource = RTResource(requestTrackerRestApiUrl, requestTrackerUsername, requestT
 
 # other
 import argparse
+import collections
+import cProfile
+import functools
+import hashlib
+import json
 import logging
+import math
+import os
 import praw
 import time
+import socket
 import sqlite3
 import sys, traceback
+import threading
 from datetime import datetime
 from datetime import timedelta  
 import unicodedata # normalize unicode strings.
 
 prawUserAgent = 'ModMailTicketCreator v0.01 by /u/Pentom'
+workerId = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+
+# Shadow mode state.  Set up from the command line before init() since it swaps out the database filename.
+shadowModeEnabled = False
+shadowFirstFakeTicketId = 900000000 # Tickets we pretend to create get ids from here up, so real ticket ids never collide.
+shadowNextFakeTicketId = shadowFirstFakeTicketId
+shadowRecordedWrites = [] # Only since the last report, they get appended to shadowWritesFilename and dropped.
+shadowWriteCounts = {} # Per action, for the whole run.
+shadowWritesFilename = None
+shadowHandledModmailReplies = set() # (ticketId, replyText) pairs.  The custom field never really gets cleared in shadow mode.
+shadowStageTimings = {}
+shadowStartTime = time.time()
+listingRecordFilename = None
+listingReplayFilename = None
+listingReplaySpeed = 1.0
+
+# Stand-in for a praw modmail message when replaying a recorded listing.
+RecordedModMail = collections.namedtuple('RecordedModMail', 'id author subject body created_utc replies')
 
 # Command line argument parsing
 arg_parser = argparse.ArgumentParser(description='Modmail / RequestTracker ticket daemon')
 arg_parser.add_argument('-l', '--logfile', help='The log file to store output in addition to stdout')
+arg_parser.add_argument('-w', '--worker-id', help='Unique name for this copy when workerModeEnabled is on (defaults to hostname:pid)')
+arg_parser.add_argument('--profile-cycles', type=int, default=0, metavar='N', help='Profile every Nth processing cycle, writing a profile dump and collapsed stacks per cycle')
+arg_parser.add_argument('--profile-sampling', action='store_true', help='Keep a low overhead stack sampler running and periodically log the hottest functions')
+arg_parser.add_argument('--shadow', action='store_true', help='Read modmail for real but only record ticket system and reddit writes, using a scratch copy of the database')
+arg_parser.add_argument('--shadow-fresh-state', action='store_true', help='Start the shadow scratch database empty instead of copying the real one')
+arg_parser.add_argument('--record-listing', metavar='FILE', help='Save the modmail listing read by the first successful cycle to FILE')
+arg_parser.add_argument('--replay-listing', metavar='FILE', help='Run one shadow cycle against a listing saved with --record-listing instead of reddit, then exit.  Normally paired with --shadow-fresh-state')
+arg_parser.add_argument('--replay-speed', type=float, default=1.0, metavar='X', help='Replay the listing X times faster than it was recorded, 0 for no waiting (default 1)')
+arg_parser.add_argument('-c', '--compact', action='store_true', help='Move threads older than the retention period into the archive database, report the space reclaimed and exit')
 
 
 def logException():
@@ -145,6 +230,27 @@ def logException():
   log.debug('\n'.join(msg))
 
 
+# Decorator for the stages we report timings for in shadow mode.  Does nothing but call through otherwise.
+def shadowTimedStage(stageName):
+	def decorator(function):
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			if not shadowModeEnabled:
+				return function(*args, **kwargs)
+			startTime = time.time()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				addShadowStageTiming(stageName, time.time() - startTime)
+		return wrapper
+	return decorator
+
+def addShadowStageTiming(stageName, elapsedSeconds):
+	timing = shadowStageTimings.setdefault(stageName, {'calls':0, 'seconds':0.0})
+	timing['calls'] += 1
+	timing['seconds'] += elapsedSeconds
+
+
 def setupLogger(log_level=logging.INFO, log_file=None):
 	global log
 	logfmt = logging.Formatter('[%(asctime)s] %(message)s', datefmt='%Y-%m-%dT%H:%M:%S')
@@ -173,23 +279,62 @@ def init():
 	global sqlConn
 	global sqlCursor
 	global nextExtendedValidationInterval
+	global archiveBloomFilter
+	global archiveBloomFilterGeneration
+	global workerOwnedPartitions
+	global workerLeasesValidUntil
+	global cycleInProgress
+	global profileEveryNthCycle
+	global productionStackSampler
 
 	sqlConn = None
 	sqlCursor = None
+	archiveBloomFilter = None
+	archiveBloomFilterGeneration = None
+	workerOwnedPartitions = []
+	workerLeasesValidUntil = 0
+	cycleInProgress = False
+	profileEveryNthCycle = 0
+	productionStackSampler = None
 	
 	period = (datetime.now() + timedelta(minutes=redditMinutesBetweenExtendedValidationMode) - datetime(1970,1,1))
 	nextExtendedValidationInterval = period.days * 86400 + period.seconds
 	
 	openSqlConnections()
-	sql = 'CREATE TABLE IF NOT EXISTS ' + sqliteDatabaseTablename + '(CommentId TEXT PRIMARY KEY, ParentCommentId TEXT, TicketId INTEGER, CHECK((ParentCommentId is null and TicketId is not null) OR (ParentCommentId is not null and TicketId is null)));'
+	sql = 'CREATE TABLE IF NOT EXISTS ' + sqliteDatabaseTablename + '(CommentId TEXT PRIMARY KEY, ParentCommentId TEXT, TicketId INTEGER, MessageUtc INTEGER, CHECK((ParentCommentId is null and TicketId is not null) OR (ParentCommentId is not null and TicketId is null)));'
 	sqlCursor.execute(sql)
 	closeSqlConnections()
 	openSqlConnections()
 	sql = 'CREATE UNIQUE INDEX IF NOT EXISTS UQ_' + sqliteDatabaseTablename + '_ParentCommentId_CommentId ON ' + sqliteDatabaseTablename + '(ParentCommentId, CommentId);'
 	sqlCursor.execute(sql)
 	closeSqlConnections()
+	migrateHandledTicketsTable()
+	openSqlConnections()
+	sql = 'CREATE TABLE IF NOT EXISTS ' + sqliteDatabaseTablename + 'ArchiveFilter(FilterId INTEGER PRIMARY KEY, BitCount INTEGER, HashCount INTEGER, Bits BLOB, Generation INTEGER, CHECK(FilterId = 1));'
+	sqlCursor.execute(sql)
+	sqlCursor.execute('PRAGMA table_info(' + sqliteDatabaseTablename + 'ArchiveFilter);')
+	if not 'Generation' in [row[1] for row in sqlCursor.fetchall()]:
+		sqlCursor.execute('ALTER TABLE ' + sqliteDatabaseTablename + 'ArchiveFilter ADD COLUMN Generation INTEGER;')
+		sqlCursor.execute('UPDATE ' + sqliteDatabaseTablename + 'ArchiveFilter SET Generation = 1;')
+	closeSqlConnections()
+	loadArchiveBloomFilter()
+	if workerModeEnabled:
+		initWorkerLeaseTables()
 	setGlobalVariablesForExtendedValidationMode()
 	
+# Databases created before retention existed do not have a MessageUtc column.  Add it and stamp the existing rows with
+#	the current time, so they stay hot for one full retention period before --compact will consider them.
+def migrateHandledTicketsTable():
+	openSqlConnections()
+	sqlCursor.execute('PRAGMA table_info(' + sqliteDatabaseTablename + ');')
+	columnNames = [row[1] for row in sqlCursor.fetchall()]
+	if not 'MessageUtc' in columnNames:
+		log.info('Adding MessageUtc column to ' + sqliteDatabaseTablename + ' for retention.')
+		period = (datetime.utcnow() - datetime(1970,1,1))
+		sqlCursor.execute('ALTER TABLE ' + sqliteDatabaseTablename + ' ADD COLUMN MessageUtc INTEGER;')
+		sqlCursor.execute('UPDATE ' + sqliteDatabaseTablename + ' SET MessageUtc = ? WHERE MessageUtc is null;', (period.days * 86400 + period.seconds,))
+	closeSqlConnections()
+	
 	
 def openSqlConnections():
 	global sqlConn
@@ -213,9 +358,11 @@ def closeSqlConnections():
 def processModMail():
 	global nextExtendedValidationInterval
 	
+	global listingRecordFilename
+	
 	try:
-		r = praw.Reddit(user_agent=prawUserAgent)
-		r.login(redditUsername,redditPassword)
+		# --compact may have run from cron since the last cycle.
+		refreshArchiveBloomFilterIfChanged()
 		
 		inExtendedValidationMode = False
 		
@@ -228,9 +375,27 @@ def processModMail():
 			nextExtendedValidationInterval = period.days * 86400 + period.seconds
 			inExtendedValidationMode = True
 		
-		log.debug('Logged into Reddit.')
-		sub = r.get_subreddit(redditSubredditToMonitor)
-		for mail in sub.get_mod_mail(limit=redditMaximumNumberOfRootThreadsToLookBack):
+		# A recorded or replayed cycle should cover the whole recent listing, not just what is new since the last
+		#	cycle, otherwise it stops at the first thread that is already handled.
+		if listingRecordFilename or listingReplayFilename:
+			setGlobalVariablesForExtendedValidationMode()
+			inExtendedValidationMode = True
+		
+		if listingReplayFilename:
+			log.info('Replaying modmail listing from ' + listingReplayFilename + '.')
+			listing = replayModMailListing(listingReplayFilename, listingReplaySpeed)
+		else:
+			r = praw.Reddit(user_agent=prawUserAgent)
+			r.login(redditUsername,redditPassword)
+			log.debug('Logged into Reddit.')
+			sub = r.get_subreddit(redditSubredditToMonitor)
+			listing = sub.get_mod_mail(limit=redditMaximumNumberOfRootThreadsToLookBack)
+		
+		recordedListing = []
+		for mail, fetchSeconds in timeModMailListing(listing):
+			
+			if listingRecordFilename:
+				recordedListing.append(getRecordableModMail(mail, fetchSeconds))
 			
 			# When we are processing a message, we have the information to know if we should continue
 			# processing.  This will keep returning true until we hit some message where we should hit falses.
@@ -238,6 +403,13 @@ def processModMail():
 			
 			if not shouldContinueProcessing:
 				break
+		
+		# Only one cycle gets recorded.  If this one blew up we will try again next cycle.
+		if listingRecordFilename:
+			with open(listingRecordFilename, 'w') as recordFile:
+				json.dump(recordedListing, recordFile)
+			log.info('Recorded {0} modmail threads to {1}.'.format(len(recordedListing), listingRecordFilename))
+			listingRecordFilename = None
 	except:
 		# Errors will happen here, Reddit fails all the time.
 		# Do not vulgarly error out.
@@ -281,6 +453,7 @@ def setGlobalVariablesForExtendedValidationMode():
 	extendedValidationModeOldDatePeriod = period.days * 86400 + period.seconds
 	
 	
+@shadowTimedStage('modmail root message processing')
 def processModMailRootMessage(debug, mail, inExtendedValidationMode):
 	shouldContinueProcessingMail = True
 	alreadyProcessedAllItems = True
@@ -316,6 +489,17 @@ def processModMailRootMessage(debug, mail, inExtendedValidationMode):
 	
 	# track the newest age value amongst root and replies.
 	messageNewestAge = rootAge
+	
+	# In multi-worker mode another worker may own this thread.  Leave it alone and never stop on it - the owner may
+	#	have already handled it while our own threads further down still need work.  Only a fully processed thread
+	#	we own ends our pass.  The absolute oldest date cutoff still applies, which is all passing False here checks.
+	if not doesWorkerOwnRootMessage(rootMessageId):
+		log.debug('Core message belongs to another worker.  Skipping.')
+		for reply in rootReplies:
+			replyAge = int(round(float(str(reply.created_utc))))
+			if replyAge > messageNewestAge:
+				messageNewestAge = replyAge
+		return shouldAnyMoreMessagesBeProcessed(False, messageNewestAge, inExtendedValidationMode)
 		
 	log.debug('Checking if core message is handled yet.  Subject:  ' + rootSubject)
 		
@@ -336,7 +520,7 @@ def processModMailRootMessage(debug, mail, inExtendedValidationMode):
 		if ticketId < 1:
 			raise LookupError('Did not get back appropriate ticket id to store from ticket system')
 		
-		noteTheFactWeProcessedAMessageId(rootMessageId, None, ticketId)
+		noteTheFactWeProcessedAMessageId(rootMessageId, None, ticketId, rootAge)
 	else:
 		log.debug('Core message found in system already.')
 			
@@ -359,7 +543,12 @@ def processModMailRootMessage(debug, mail, inExtendedValidationMode):
 	
 	return shouldContinueProcessingMail
 
+@shadowTimedStage('request tracker reads')
 def getTicketData(ticketId):
+	# Tickets we only pretended to create in shadow mode do not exist, dont go asking for them.
+	if shadowModeEnabled and ticketId >= shadowFirstFakeTicketId:
+		return []
+	
 	try:
 		getTicketStatusUrl = 'ticket/' + str(ticketId)
 		response = resource.get(path=getTicketStatusUrl)
@@ -384,6 +573,7 @@ def getTicketData(ticketId):
 		logException()
 		return []
 
+@shadowTimedStage('recorded writes')
 def setTicketStateTo(ticketId, newState):
 	try:
 		content = {
@@ -392,6 +582,9 @@ def setTicketStateTo(ticketId, newState):
 			}
 		}
 		responseUrl = 'ticket/' + str(ticketId) + '/edit'
+		if shadowModeEnabled:
+			recordShadowWrite('setTicketStateTo', responseUrl, content)
+			return
 		response = resource.post(path=responseUrl, payload=content,)
 	except:
 		# Do not vulgarly error out.
@@ -422,21 +615,23 @@ def transitionTicketToExpectedState(ticketId):
 	
 		
 	
-def noteTheFactWeProcessedAMessageId(messageId, parentMessageId, ticketId):
+@shadowTimedStage('sqlite')
+def noteTheFactWeProcessedAMessageId(messageId, parentMessageId, ticketId, messageEpochTimeUtc):
 	openSqlConnections()
 	sql = ''
 	
 	if parentMessageId == None:
-		sql = 'INSERT INTO ' + sqliteDatabaseTablename + '(ParentCommentId, CommentId, TicketId) values (null, ?, ?);'
-		sqlCursor.execute(sql, (messageId,ticketId))
+		sql = 'INSERT INTO ' + sqliteDatabaseTablename + '(ParentCommentId, CommentId, TicketId, MessageUtc) values (null, ?, ?, ?);'
+		sqlCursor.execute(sql, (messageId,ticketId,messageEpochTimeUtc))
 	else:
-		sql = 'INSERT INTO ' + sqliteDatabaseTablename + '(ParentCommentId, CommentId, TicketId) values (?, ?, null);'
-		sqlCursor.execute(sql, (parentMessageId,messageId))
+		sql = 'INSERT INTO ' + sqliteDatabaseTablename + '(ParentCommentId, CommentId, TicketId, MessageUtc) values (?, ?, null, ?);'
+		sqlCursor.execute(sql, (parentMessageId,messageId,messageEpochTimeUtc))
 		
 	
 	sqlConn.commit()
 	closeSqlConnections()
 
+@shadowTimedStage('sqlite')
 def getHasReplyBeenProcessed(rootMessageId, replyMessageId):
 	processed = True
 	
@@ -453,8 +648,13 @@ def getHasReplyBeenProcessed(rootMessageId, replyMessageId):
 
 	closeSqlConnections()
 	
+	# Not in the hot table - only bother the archive if the bloom filter says it might be there.
+	if not processed and isMessageIdPossiblyArchived(replyMessageId):
+		processed = getArchiveRow(sql, (rootMessageId,replyMessageId)) != None
+	
 	return processed
 	
+@shadowTimedStage('sqlite')
 def getTicketIdForAlreadyProcessedRootMessage(rootMessageId):
 	ticketId = None
 	
@@ -469,6 +669,13 @@ def getTicketIdForAlreadyProcessedRootMessage(rootMessageId):
 	
 	closeSqlConnections()
 	
+	# Not in the hot table - only bother the archive if the bloom filter says it might be there.
+	if ticketId == None and isMessageIdPossiblyArchived(rootMessageId):
+		sqlrow = getArchiveRow(sql, (rootMessageId,))
+		if sqlrow != None:
+			log.debug('Core message found in archive.')
+			ticketId = sqlrow[0]
+	
 	return ticketId
 
 # In reply object
@@ -510,7 +717,7 @@ def handleMessageReplies(debug, ticketId, rootMessageId, replies, messageNewestA
 			
 			addTicketComment(ticketId, replyAuthor, replyBody, rootResponseUrl)
 			
-			noteTheFactWeProcessedAMessageId(replyMessageId, rootMessageId, None)
+			noteTheFactWeProcessedAMessageId(replyMessageId, rootMessageId, None, replyAge)
 		else:
 			log.debug('Reply message already found in system.')
 	
@@ -519,6 +726,7 @@ def handleMessageReplies(debug, ticketId, rootMessageId, replies, messageNewestA
 # no error handling, let errors bubble up.
 # in - message information
 # out integer ticket id.
+@shadowTimedStage('recorded writes')
 def createTicket(author, subject, body, modmailMessageUrl, rtQueueId):
 	postedSubject = requestTrackerInitialTicketCreationSubject.replace("{Author}", author).replace("{Subject}", subject).replace("{ModmailMessageUrl}", modmailMessageUrl).replace("{Content}", body)
 	postedBody = requestTrackerInitialTicketCreationComment.replace("{Author}", author).replace("{Subject}", subject).replace("{ModmailMessageUrl}", modmailMessageUrl).replace("{Content}", body)
@@ -531,6 +739,9 @@ def createTicket(author, subject, body, modmailMessageUrl, rtQueueId):
 	}
 	
 	log.debug('Creating core ticket for queue:  ' + str(rtQueueId))
+	if shadowModeEnabled:
+		recordShadowWrite('createTicket', 'ticket/new', content)
+		return getNextShadowFakeTicketId()
 	response = resource.post(path='ticket/new', payload=content,)
 
 	# if this wasnt successful, the following statements will error out and send us down to the catch.
@@ -542,6 +753,7 @@ def createTicket(author, subject, body, modmailMessageUrl, rtQueueId):
 # no error handling, let errors bubble up.
 # in - message information
 # out None
+@shadowTimedStage('recorded writes')
 def addTicketComment(ticketId, author, body, modmailMessageUrl):
 	postedBody = requestTrackerThreadReply.replace("{Author}", author).replace("{ModmailMessageUrl}", modmailMessageUrl).replace("{Content}", body)
 	params = {
@@ -551,6 +763,9 @@ def addTicketComment(ticketId, author, body, modmailMessageUrl):
 		}
 	}
 	ticketUpdatePath = 'ticket/' + str(ticketId) + '/comment'
+	if shadowModeEnabled:
+		recordShadowWrite('addTicketComment', ticketUpdatePath, params)
+		return
 	response = resource.post(path=ticketUpdatePath, payload=params,)
 	
 	# if this wasnt successful, the type will not be 200 and we will be sent down to the except.
@@ -603,6 +818,17 @@ def processTicketModmailReply(ticketId, replyText, prawContext):
 			log.warning('Could not find reddit post url for ticket id ' + str(ticketId) + '.')
 			return
 		
+		if not doesWorkerOwnRootMessage(redditUrl.split('/')[-1]):
+			log.debug('Ticket id ' + str(ticketId) + ' belongs to another worker, leaving its modmail reply alone.')
+			return
+		
+		# In shadow mode the ticket keeps showing up in the search every cycle, so only record it once.
+		if shadowModeEnabled:
+			if (ticketId, replyText) in shadowHandledModmailReplies:
+				log.debug('Shadow - modmail reply for ticket id ' + str(ticketId) + ' already recorded this run.')
+				return
+			shadowHandledModmailReplies.add((ticketId, replyText))
+		
 		# Edge case - we didnt note that we replied into reddit but we actually did.
 		# Probable cause request tracker or network glitch or reddit marking a 'failed' action for something that succeeded.
 		# Lets check to see if we have handled this.
@@ -620,6 +846,7 @@ def processTicketModmailReply(ticketId, replyText, prawContext):
 # help such.
 # Note - this is a 'nice to have' so if we have an issue with this call, we can assume that it hasnt got 
 #	a reply - just to keep this train moving.
+@shadowTimedStage('request tracker reads')
 def checkIfAlreadyHandledModmailReply(ticketId, modmailMessageUrl, replyText):
 	isAlreadyHandled = False
 	
@@ -657,15 +884,21 @@ def checkIfAlreadyHandledModmailReply(ticketId, modmailMessageUrl, replyText):
 	return isAlreadyHandled
 
 # No error handling, let errors fail this call and bubble up.		
+@shadowTimedStage('recorded writes')
 def postRedditModmailReply(redditUrl, replyText, prawContext):
 	log.debug('Sending modmail reply to redditurl ' + redditUrl + ':  ' + replyText)
 		
 	full_reply_text = requestTrackerRedditModmailReply.replace("{Content}", replyText)
 	
+	if shadowModeEnabled:
+		recordShadowWrite('postRedditModmailReply', redditUrl, full_reply_text)
+		return
+	
 	message_link = prawContext.get_content(url=redditUrl)
 	for message in message_link:
 		message.reply(full_reply_text)
 		
+@shadowTimedStage('recorded writes')
 def removeModmailReplyFromTicket(ticketId):
 	log.debug('Removing modmail reply attribute from ticket ' + str(ticketId) + '.')
 	
@@ -675,6 +908,9 @@ def removeModmailReplyFromTicket(ticketId):
 		}
 	}
 	try:
+		if shadowModeEnabled:
+			recordShadowWrite('removeModmailReplyFromTicket', 'ticket/' + str(ticketId) + '/edit', content)
+			return
 		response = resource.post(path='ticket/' + str(ticketId) + '/edit', payload=content,)
 		if response.status_int != 200:
 			raise LookupError('Was unable to update expected ticket, we should defensively exit here.')
@@ -691,6 +927,7 @@ def removeModmailReplyFromTicket(ticketId):
 		sys.exit(1)
 
 		
+@shadowTimedStage('sqlite')
 def getRedditPostUrlFromTicketId(ticketId):
 	returnValue = None
 	
@@ -700,25 +937,557 @@ def getRedditPostUrlFromTicketId(ticketId):
 	sqlCursor.execute(sql, (ticketId,)) # [sic] you have to pass in a sequence.  
 	
 	sqlrow = sqlCursor.fetchone()
+	
+	closeSqlConnections()
+	
+	# The bloom filter is keyed on comment ids, not ticket ids, so a miss here always checks the archive.
+	#	This only happens when someone queues a modmail reply on a ticket so it is not worth another filter.
+	if sqlrow == None:
+		sqlrow = getArchiveRow(sql, (ticketId,))
+	
 	if sqlrow != None:
 		log.debug('Found CommentId for ticketId')
 		returnValue = 'https://www.reddit.com/message/messages/' + str(sqlrow[0])
 		log.debug('Reddit main modmail reply url is \'' + returnValue + '\'')
 	
+	return returnValue
+
+# Runs a single-row query against the archive file.  Returns None if there is no archive yet.
+# Uses its own connection so we never disturb the hot connection globals.
+def getArchiveRow(sql, parameters):
+	sqlrow = None
+
+	if not os.path.exists(sqliteArchiveDatabaseFilename):
+		return sqlrow
+
+	archiveConn = sqlite3.connect(sqliteArchiveDatabaseFilename)
+	try:
+		archiveCursor = archiveConn.cursor()
+		archiveCursor.execute(sql, parameters)
+		sqlrow = archiveCursor.fetchone()
+		archiveCursor.close()
+	finally:
+		archiveConn.close()
+
+	return sqlrow
+
+# Bloom filter over every CommentId in the archive.  Stored as a single row in the hot file, loaded once at init and
+#	rebuilt by --compact.  A miss means the id is definitely not archived, a hit means go look.
+def loadArchiveBloomFilter():
+	global archiveBloomFilter
+	global archiveBloomFilterGeneration
+	archiveBloomFilter = None
+	archiveBloomFilterGeneration = None
+
+	openSqlConnections()
+
+	sql = 'select BitCount, HashCount, Bits, Generation from ' + sqliteDatabaseTablename + 'ArchiveFilter where FilterId = 1;'
+	sqlCursor.execute(sql)
+
+	sqlrow = sqlCursor.fetchone()
+	if sqlrow != None:
+		archiveBloomFilter = {'bitCount':sqlrow[0], 'hashCount':sqlrow[1], 'bits':bytearray(sqlrow[2])}
+		archiveBloomFilterGeneration = sqlrow[3]
+		log.debug('Loaded archive bloom filter generation {0} with {1} bits and {2} hashes.'.format(sqlrow[3], sqlrow[0], sqlrow[1]))
+
 	closeSqlConnections()
+
+# --compact normally runs as its own process while we keep going, so our copy of the filter can go stale.  Every
+#	rebuild bumps Generation, and checking it is a single-row select, so we do it before trusting a filter miss.
+def refreshArchiveBloomFilterIfChanged():
+	openSqlConnections()
+
+	sql = 'select Generation from ' + sqliteDatabaseTablename + 'ArchiveFilter where FilterId = 1;'
+	sqlCursor.execute(sql)
+
+	sqlrow = sqlCursor.fetchone()
+	closeSqlConnections()
+
+	currentGeneration = None
+	if sqlrow != None:
+		currentGeneration = sqlrow[0]
+
+	if currentGeneration != archiveBloomFilterGeneration:
+		log.info('Archive bloom filter changed (generation {0}), reloading.'.format(currentGeneration))
+		loadArchiveBloomFilter()
+
+# Double hashing (Kirsch-Mitzenmacher) off a single md5 so we only hash each id once.
+def getArchiveBloomFilterBitPositions(bitCount, hashCount, messageId):
+	digest = hashlib.md5(str(messageId).encode('utf-8')).hexdigest()
+	firstHash = int(digest[:16], 16)
+	secondHash = int(digest[16:], 16) | 1
+	return [(firstHash + i * secondHash) % bitCount for i in range(hashCount)]
+
+# Only called after a hot table miss, which is about to be treated as new, so make sure the filter is current first.
+def isMessageIdPossiblyArchived(messageId):
+	refreshArchiveBloomFilterIfChanged()
+
+	if archiveBloomFilter == None:
+		return False
+
+	bits = archiveBloomFilter['bits']
+	for position in getArchiveBloomFilterBitPositions(archiveBloomFilter['bitCount'], archiveBloomFilter['hashCount'], messageId):
+		if not bits[position >> 3] & (1 << (position & 7)):
+			return False
+
+	return True
+
+# Expects sqlCursor to have the archive attached as 'archive'.  Sized for the current archive row count
+#	and sqliteArchiveBloomFilterFalsePositiveRate.
+def rebuildArchiveBloomFilter():
+	sqlCursor.execute('select count(*) from archive.' + sqliteDatabaseTablename + ';')
+	itemCount = max(sqlCursor.fetchone()[0], 1)
+
+	bitCount = max(int(math.ceil(-itemCount * math.log(sqliteArchiveBloomFilterFalsePositiveRate) / (math.log(2) ** 2))), 64)
+	hashCount = max(int(round(float(bitCount) / itemCount * math.log(2))), 1)
+	bits = bytearray((bitCount + 7) // 8)
+
+	sqlCursor.execute('select CommentId from archive.' + sqliteDatabaseTablename + ';')
+	for sqlrow in sqlCursor:
+		for position in getArchiveBloomFilterBitPositions(bitCount, hashCount, sqlrow[0]):
+			bits[position >> 3] |= (1 << (position & 7))
+
+	sql = 'INSERT OR REPLACE INTO ' + sqliteDatabaseTablename + 'ArchiveFilter(FilterId, BitCount, HashCount, Bits, Generation) values (1, ?, ?, ?, (select coalesce(max(Generation), 0) + 1 from ' + sqliteDatabaseTablename + 'ArchiveFilter));'
+	sqlCursor.execute(sql, (bitCount, hashCount, sqlite3.Binary(bytes(bits))))
+
+	return len(bits)
+
+# Moves every thread (root plus replies) whose newest message is older than the retention period into the
+#	archive file, rebuilds the bloom filter, then vacuums the hot file and reports how much space came back.
+# No error handling, if this fails we want to know about it - the move happens in one transaction so nothing is lost.
+def compactHandledTickets():
+	retentionDays = max(sqliteArchiveThreadsOlderThanDays, redditMaximumAmountOfDaysToAllowLookbackForMissingReplies)
+	period = (datetime.utcnow() - timedelta(days=retentionDays) - datetime(1970,1,1))
+	oldestMessageUtcToKeep = period.days * 86400 + period.seconds
+
+	log.info('Compacting ' + sqliteDatabaseTablename + ', archiving threads with no messages in the last {0} days.'.format(retentionDays))
+
+	sizeBefore = os.path.getsize(sqliteDatabaseFilename)
+
+	openSqlConnections()
+	sqlCursor.execute('ATTACH DATABASE ? AS archive;', (sqliteArchiveDatabaseFilename,))
+	sql = 'CREATE TABLE IF NOT EXISTS archive.' + sqliteDatabaseTablename + '(CommentId TEXT PRIMARY KEY, ParentCommentId TEXT, TicketId INTEGER, MessageUtc INTEGER, CHECK((ParentCommentId is null and TicketId is not null) OR (ParentCommentId is not null and TicketId is null)));'
+	sqlCursor.execute(sql)
+	sql = 'CREATE UNIQUE INDEX IF NOT EXISTS archive.UQ_' + sqliteDatabaseTablename + '_ParentCommentId_CommentId ON ' + sqliteDatabaseTablename + '(ParentCommentId, CommentId);'
+	sqlCursor.execute(sql)
+	sql = 'CREATE INDEX IF NOT EXISTS archive.IX_' + sqliteDatabaseTablename + '_TicketId ON ' + sqliteDatabaseTablename + '(TicketId);'
+	sqlCursor.execute(sql)
+
+	# A thread is keyed by its root id.  Replies to an already archived root still group under that root here.
+	threadFilter = ' where coalesce(ParentCommentId, CommentId) in (select coalesce(ParentCommentId, CommentId) from main.' + sqliteDatabaseTablename + ' group by coalesce(ParentCommentId, CommentId) having max(MessageUtc) < ?);'
+
+	sql = 'select count(*) from (select 1 from main.' + sqliteDatabaseTablename + ' group by coalesce(ParentCommentId, CommentId) having max(MessageUtc) < ?);'
+	sqlCursor.execute(sql, (oldestMessageUtcToKeep,))
+	archivedThreadCount = sqlCursor.fetchone()[0]
+	sql = 'INSERT OR IGNORE INTO archive.' + sqliteDatabaseTablename + '(CommentId, ParentCommentId, TicketId, MessageUtc) select CommentId, ParentCommentId, TicketId, MessageUtc from main.' + sqliteDatabaseTablename + threadFilter
+	sqlCursor.execute(sql, (oldestMessageUtcToKeep,))
+	sql = 'DELETE FROM main.' + sqliteDatabaseTablename + threadFilter
+	sqlCursor.execute(sql, (oldestMessageUtcToKeep,))
+	archivedRowCount = sqlCursor.rowcount
+
+	bloomFilterBytes = rebuildArchiveBloomFilter()
+	sqlConn.commit()
+
+	sqlCursor.execute('DETACH DATABASE archive;')
+	sqlCursor.execute('VACUUM;')
+	closeSqlConnections()
+
+	loadArchiveBloomFilter()
+
+	sizeAfter = os.path.getsize(sqliteDatabaseFilename)
+	log.info('Archived {0} rows ({1} threads) into {2}.'.format(archivedRowCount, archivedThreadCount, sqliteArchiveDatabaseFilename))
+	log.info('{0} went from {1} to {2} bytes, reclaimed {3} bytes.  Bloom filter is {4} bytes, archive is {5} bytes.'.format(sqliteDatabaseFilename, sizeBefore, sizeAfter, sizeBefore - sizeAfter, bloomFilterBytes, os.path.getsize(sqliteArchiveDatabaseFilename)))
+
+def initWorkerLeaseTables():
+	openSqlConnections()
+	sql = 'CREATE TABLE IF NOT EXISTS ' + sqliteDatabaseTablename + 'Workers(WorkerId TEXT PRIMARY KEY, HeartbeatUtc INTEGER);'
+	sqlCursor.execute(sql)
+	sql = 'CREATE TABLE IF NOT EXISTS ' + sqliteDatabaseTablename + 'Leases(PartitionId INTEGER PRIMARY KEY, WorkerId TEXT, ExpiresUtc INTEGER);'
+	sqlCursor.execute(sql)
+	closeSqlConnections()
+
+	# Make sure the lease rows match workerPartitionCount, in case someone changed it between runs.
+	openSqlConnections()
+	sql = 'INSERT OR IGNORE INTO ' + sqliteDatabaseTablename + 'Leases(PartitionId, WorkerId, ExpiresUtc) values (?, null, 0);'
+	sqlCursor.executemany(sql, [(partitionId,) for partitionId in range(workerPartitionCount)])
+	sql = 'DELETE FROM ' + sqliteDatabaseTablename + 'Leases where PartitionId >= ?;'
+	sqlCursor.execute(sql, (workerPartitionCount,))
+	closeSqlConnections()
+
+	log.info('Running as worker ' + workerId + ' over {0} partitions.'.format(workerPartitionCount))
+
+# Root ids are base 36, so the partition is just that number mod the partition count.
+def getPartitionIdForRootMessage(rootMessageId):
+	return int(rootMessageId, 36) % workerPartitionCount
+
+# Heartbeat.  Called at the top of every cycle (and mid-cycle by doesWorkerOwnRootMessage if a cycle runs long).
+# Keeps our own leases alive, then grabs or gives back partitions so every live worker holds about the same amount.
+# The heartbeat write comes first so we hold the sqlite write lock for the whole claim - two workers can never
+#	claim the same partition.
+def renewWorkerLeases():
+	global workerOwnedPartitions
+	global workerLeasesValidUntil
+
+	period = (datetime.utcnow() - datetime(1970,1,1))
+	now = period.days * 86400 + period.seconds
+	expiresUtc = now + workerLeaseDurationInSeconds
+
+	try:
+		openSqlConnections()
+
+		sql = 'INSERT OR REPLACE INTO ' + sqliteDatabaseTablename + 'Workers(WorkerId, HeartbeatUtc) values (?, ?);'
+		sqlCursor.execute(sql, (workerId, now))
+		sql = 'DELETE FROM ' + sqliteDatabaseTablename + 'Workers where HeartbeatUtc < ?;'
+		sqlCursor.execute(sql, (now - workerLeaseDurationInSeconds,))
+		sqlCursor.execute('select count(*) from ' + sqliteDatabaseTablename + 'Workers;')
+		liveWorkerCount = sqlCursor.fetchone()[0]
+		fairShare = int(math.ceil(float(workerPartitionCount) / liveWorkerCount))
+
+		sql = 'UPDATE ' + sqliteDatabaseTablename + 'Leases SET ExpiresUtc = ? where WorkerId = ? and ExpiresUtc >= ?;'
+		sqlCursor.execute(sql, (expiresUtc, workerId, now))
+		sql = 'select PartitionId from ' + sqliteDatabaseTablename + 'Leases where WorkerId = ? and ExpiresUtc >= ? order by PartitionId;'
+		sqlCursor.execute(sql, (workerId, now))
+		ownedPartitions = [sqlrow[0] for sqlrow in sqlCursor.fetchall()]
+
+		if len(ownedPartitions) > fairShare:
+			# Someone new showed up, give back our extras.  They get claimed on the newcomers next heartbeat.
+			sql = 'UPDATE ' + sqliteDatabaseTablename + 'Leases SET WorkerId = null, ExpiresUtc = 0 where PartitionId = ?;'
+			sqlCursor.executemany(sql, [(partitionId,) for partitionId in ownedPartitions[fairShare:]])
+			ownedPartitions = ownedPartitions[:fairShare]
+		elif len(ownedPartitions) < fairShare:
+			# Unowned or expired (dead worker) partitions are up for grabs.
+			sql = 'select PartitionId from ' + sqliteDatabaseTablename + 'Leases where WorkerId is null or ExpiresUtc < ? order by PartitionId limit ?;'
+			sqlCursor.execute(sql, (now, fairShare - len(ownedPartitions)))
+			claimedPartitions = [sqlrow[0] for sqlrow in sqlCursor.fetchall()]
+			sql = 'UPDATE ' + sqliteDatabaseTablename + 'Leases SET WorkerId = ?, ExpiresUtc = ? where PartitionId = ?;'
+			sqlCursor.executemany(sql, [(workerId, expiresUtc, partitionId) for partitionId in claimedPartitions])
+			ownedPartitions = sorted(ownedPartitions + claimedPartitions)
+			if len(claimedPartitions) > 0:
+				log.info('Worker ' + workerId + ' claimed partitions ' + str(claimedPartitions) + '.')
+
+		closeSqlConnections()
+
+		workerOwnedPartitions = ownedPartitions
+		workerLeasesValidUntil = expiresUtc
+		log.debug('Worker ' + workerId + ' holds partitions ' + str(ownedPartitions) + ' of {0} with {1} live workers.'.format(workerPartitionCount, liveWorkerCount))
+	except:
+		# Do not vulgarly error out.  Worst case our leases lapse and we stop writing until the next heartbeat works.
+		e = str(sys.exc_info()[0])
+		l = str(sys.exc_traceback.tb_lineno)
+		log.error('Error when attempting to renewWorkerLeases on line number {0}.  Exception:  {1}'.format(l, e))
+		logException()
+		# Roll back rather than commit - a half applied release would leave us writing to partitions we gave away.
+		if not sqlConn == None:
+			sqlConn.rollback()
+		closeSqlConnections()
+		pass
+
+# Only write for threads in partitions we hold.  Past the halfway point of our leases we heartbeat again, so any thread we
+#	say yes to has at least half a lease duration left to finish its ticket system writes before anyone else could take over.
+def doesWorkerOwnRootMessage(rootMessageId):
+	if not workerModeEnabled:
+		return True
+
+	period = (datetime.utcnow() - datetime(1970,1,1))
+	now = period.days * 86400 + period.seconds
+	if now > workerLeasesValidUntil - workerLeaseDurationInSeconds // 2:
+		renewWorkerLeases()
+		if now > workerLeasesValidUntil - workerLeaseDurationInSeconds // 2:
+			return False
+
+	return getPartitionIdForRootMessage(rootMessageId) in workerOwnedPartitions
+
+
+# Profiling output folder sits next to the log file so it rotates/gets cleaned up alongside it.
+def setupProfiling(logFile, everyNthCycle, keepSampling):
+	global profileOutputDirectory
+	global profileEveryNthCycle
+	global productionStackSampler
+	global nextSamplingReportTime
 	
-	return returnValue
+	profileEveryNthCycle = everyNthCycle
+	if profileEveryNthCycle < 1 and not keepSampling:
+		return
+	
+	profileOutputDirectory = profileDirectoryName
+	if logFile:
+		profileOutputDirectory = os.path.join(os.path.dirname(os.path.abspath(logFile)), profileDirectoryName)
+	if not os.path.isdir(profileOutputDirectory):
+		os.makedirs(profileOutputDirectory)
 	
+	if profileEveryNthCycle > 0:
+		log.info('Profiling every {0} processing cycles into {1}.'.format(profileEveryNthCycle, profileOutputDirectory))
+	if keepSampling:
+		log.info('Sampling stacks every {0} ms, reporting every {1} minutes into {2}.'.format(profileSamplingIntervalInMilliseconds, profileSamplingReportIntervalInMinutes, profileOutputDirectory))
+		productionStackSampler = startStackSampler(profileSamplingIntervalInMilliseconds, True)
+		nextSamplingReportTime = time.time() + profileSamplingReportIntervalInMinutes * 60
 
-def mainloop():
+# Stack sampler.  A background thread that looks at the main threads current stack every interval and counts each
+#	distinct stack.  This is what the .collapsed files are made of since cProfile only records caller/callee pairs.
+def startStackSampler(intervalInMilliseconds, onlyDuringCycles):
+	sampler = {'samples':{}, 'lock':threading.Lock(), 'stopEvent':threading.Event(), 'threadId':threading.current_thread().ident, 'onlyDuringCycles':onlyDuringCycles}
+	sampler['thread'] = threading.Thread(target=runStackSampler, args=(sampler, intervalInMilliseconds / 1000.0))
+	sampler['thread'].daemon = True
+	sampler['thread'].start()
+	return sampler
+
+def runStackSampler(sampler, intervalInSeconds):
+	while not sampler['stopEvent'].is_set():
+		frame = None
+		if cycleInProgress or not sampler['onlyDuringCycles']:
+			frame = sys._current_frames().get(sampler['threadId'])
+		
+		if frame != None:
+			stack = []
+			while frame != None:
+				code = frame.f_code
+				stack.append('{0} ({1}:{2})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+				frame = frame.f_back
+			stack.reverse()
+			collapsedStack = ';'.join(stack)
+			
+			with sampler['lock']:
+				sampler['samples'][collapsedStack] = sampler['samples'].get(collapsedStack, 0) + 1
+		
+		sampler['stopEvent'].wait(intervalInSeconds)
+
+def stopStackSampler(sampler):
+	sampler['stopEvent'].set()
+	sampler['thread'].join()
+
+# Hands back everything sampled so far and starts counting from zero again.
+def takeStackSamples(sampler):
+	with sampler['lock']:
+		samples = sampler['samples']
+		sampler['samples'] = {}
+	return samples
+
+# Brendan Gregg's collapsed stack format:  'outer;inner;leaf count' one stack per line.
+def writeCollapsedStacks(filename, samples):
+	with open(filename, 'w') as collapsedFile:
+		for stack in sorted(samples.keys()):
+			collapsedFile.write('{0} {1}\n'.format(stack, samples[stack]))
+
+# Hot means the function was on top of the stack (self time), not just somewhere in it.
+def logHotFunctions(samples, description):
+	totalSamples = sum(samples.values())
+	if totalSamples == 0:
+		log.info('No stack samples for ' + description + '.')
+		return
+	
+	selfSamples = {}
+	for stack in samples:
+		leaf = stack.split(';')[-1]
+		selfSamples[leaf] = selfSamples.get(leaf, 0) + samples[stack]
+	
+	hottest = sorted(selfSamples.items(), key=lambda item: item[1], reverse=True)[:profileNumberOfHotFunctionsToReport]
+	lines = ['Hottest functions for ' + description + ' ({0} samples):'.format(totalSamples)]
+	for function, count in hottest:
+		lines.append('  {0:5.1f}%  {1}'.format(100.0 * count / totalSamples, function))
+	log.info('\n'.join(lines))
+
+def rotateProfileDirectory():
+	profileFiles = [os.path.join(profileOutputDirectory, filename) for filename in os.listdir(profileOutputDirectory) if filename.endswith('.prof') or filename.endswith('.collapsed')]
+	profileFiles.sort(key=os.path.getmtime)
+	for filename in profileFiles[:max(len(profileFiles) - profileMaximumFilesToKeep, 0)]:
+		os.remove(filename)
+
+# Runs one processing cycle under cProfile and a fine-grained stack sampler and writes both out.
+def profileProcessingCycle(cycleNumber):
+	profiler = cProfile.Profile()
+	sampler = startStackSampler(profileCycleSamplingIntervalInMilliseconds, True)
+	startTime = time.time()
+	
+	profiler.enable()
+	try:
+		processCycle()
+	finally:
+		profiler.disable()
+		stopStackSampler(sampler)
+	
+	elapsedSeconds = time.time() - startTime
+	baseFilename = os.path.join(profileOutputDirectory, 'cycle-{0}-{1}'.format(cycleNumber, datetime.utcnow().strftime('%Y%m%dT%H%M%S')))
+	try:
+		profiler.dump_stats(baseFilename + '.prof')
+		samples = takeStackSamples(sampler)
+		writeCollapsedStacks(baseFilename + '.collapsed', samples)
+		log.info('Profiled cycle {0} took {1:.2f} seconds, wrote {2}.prof and .collapsed'.format(cycleNumber, elapsedSeconds, baseFilename))
+		logHotFunctions(samples, 'cycle {0}'.format(cycleNumber))
+		rotateProfileDirectory()
+	except:
+		# Do not vulgarly error out over a profile we could not write.
+		e = str(sys.exc_info()[0])
+		l = str(sys.exc_traceback.tb_lineno)
+		log.error('Error when attempting to write cycle profile on line number {0}.  Exception:  {1}'.format(l, e))
+		logException()
+		pass
+
+def reportSampledHotFunctionsIfDue():
+	global nextSamplingReportTime
+	
+	if productionStackSampler == None or time.time() < nextSamplingReportTime:
+		return
 	
+	nextSamplingReportTime = time.time() + profileSamplingReportIntervalInMinutes * 60
+	samples = takeStackSamples(productionStackSampler)
+	try:
+		filename = os.path.join(profileOutputDirectory, 'sampled-{0}.collapsed'.format(datetime.utcnow().strftime('%Y%m%dT%H%M%S')))
+		writeCollapsedStacks(filename, samples)
+		logHotFunctions(samples, 'the last {0} minutes'.format(profileSamplingReportIntervalInMinutes))
+		rotateProfileDirectory()
+	except:
+		# Do not vulgarly error out over a profile we could not write.
+		e = str(sys.exc_info()[0])
+		l = str(sys.exc_traceback.tb_lineno)
+		log.error('Error when attempting to write sampled profile on line number {0}.  Exception:  {1}'.format(l, e))
+		logException()
+		pass
+
+# Points us at a scratch copy of the database so shadow runs never touch the real state.
+def setupShadowMode(startFresh):
+	global shadowModeEnabled
+	global shadowStartTime
+	global shadowWritesFilename
+	global sqliteDatabaseFilename
+	
+	scratchFilename = sqliteDatabaseFilename + '.shadow'
+	shadowWritesFilename = scratchFilename + '.writes.jsonl'
+	for filename in [scratchFilename, shadowWritesFilename]:
+		if os.path.exists(filename):
+			os.remove(filename)
+	if not startFresh and os.path.exists(sqliteDatabaseFilename):
+		copySqliteDatabase(sqliteDatabaseFilename, scratchFilename)
+	
+	log.info('Shadow mode - nothing will be written to the ticket system or reddit.  Using scratch database ' + scratchFilename + '.')
+	sqliteDatabaseFilename = scratchFilename
+	shadowModeEnabled = True
+	shadowStartTime = time.time()
+
+# The live daemon may be writing while we copy, so a plain file copy can come out torn or miss a hot journal.
+#	Hold a write lock on the source for the duration and dump it statement by statement into the new file.
+def copySqliteDatabase(sourceFilename, destinationFilename):
+	sourceConn = sqlite3.connect(sourceFilename, timeout=60, isolation_level=None)
+	destinationConn = sqlite3.connect(destinationFilename, isolation_level=None)
+	try:
+		sourceConn.execute('BEGIN IMMEDIATE;')
+		try:
+			for statement in sourceConn.iterdump():
+				destinationConn.execute(statement)
+		finally:
+			sourceConn.execute('ROLLBACK;')
+	finally:
+		destinationConn.close()
+		sourceConn.close()
+
+def getNextShadowFakeTicketId():
+	global shadowNextFakeTicketId
+	shadowNextFakeTicketId += 1
+	return shadowNextFakeTicketId - 1
+
+def recordShadowWrite(action, target, payload):
+	log.info('Shadow - would have done ' + action + ' against ' + target + '.')
+	shadowRecordedWrites.append({'secondsIntoRun':time.time() - shadowStartTime, 'action':action, 'target':target, 'payload':payload})
+	shadowWriteCounts[action] = shadowWriteCounts.get(action, 0) + 1
+
+# Times how long each item takes to come out of the listing, which is where PRAW does its paging.
+#	Hands back (mail, fetchSeconds) so a recording only captures reddits time and not our own processing.
+def timeModMailListing(listing):
+	iterator = iter(listing)
 	while True:
-		log.debug('Waking... Processing modmail.')
+		startTime = time.time()
+		try:
+			mail = next(iterator)
+		except StopIteration:
+			return
+		fetchSeconds = time.time() - startTime
+		if shadowModeEnabled:
+			addShadowStageTiming('modmail listing', fetchSeconds)
+		yield mail, fetchSeconds
+
+def getRecordableText(value):
+	return value if type(value) is unicode else str(value)
+
+# Keeps the raw (not yet normalized) text so a replay does the same work processModMailRootMessage does live.
+def getRecordableModMail(mail, fetchSeconds):
+	replies = []
+	for reply in mail.replies:
+		replies.append({'id':str(reply.id), 'author':getRecordableText(reply.author), 'body':getRecordableText(reply.body), 'created_utc':float(str(reply.created_utc))})
+	
+	return {'fetchSeconds':fetchSeconds, 'id':str(mail.id), 'author':getRecordableText(mail.author), 'subject':getRecordableText(mail.subject), 'body':getRecordableText(mail.body), 'created_utc':float(str(mail.created_utc)), 'replies':replies}
+
+# Hands back the recorded threads, waiting the time reddit took to hand each one over divided by speed.
+#	Our own processing time is not part of the wait, so a faster release really does finish faster.
+def replayModMailListing(filename, speed):
+	with open(filename) as recordFile:
+		recordedListing = json.load(recordFile)
+	
+	for recorded in recordedListing:
+		if speed > 0:
+			time.sleep(recorded['fetchSeconds'] / speed)
+		
+		replies = [RecordedModMail(reply['id'], reply['author'], None, reply['body'], reply['created_utc'], []) for reply in recorded['replies']]
+		yield RecordedModMail(recorded['id'], recorded['author'], recorded['subject'], recorded['body'], recorded['created_utc'], replies)
+
+# Logs the writes we would have made and where the time went.  The writes since the last report get appended
+#	(one JSON object per line) to shadowWritesFilename next to the scratch database and dropped from memory.
+def reportShadowRun():
+	elapsedSeconds = max(time.time() - shadowStartTime, 0.001)
+	totalWrites = sum(shadowWriteCounts.values())
+	
+	lines = ['Shadow run so far:  {0} writes in {1:.1f} seconds ({2:.3f} writes/second).'.format(totalWrites, elapsedSeconds, totalWrites / elapsedSeconds)]
+	for action in sorted(shadowWriteCounts.keys()):
+		lines.append('  {0:>30}  {1:6} writes  {2:8.3f} /second'.format(action, shadowWriteCounts[action], shadowWriteCounts[action] / elapsedSeconds))
+	lines.append('Stage timings (stages include the stages they call):')
+	for stageName in sorted(shadowStageTimings.keys()):
+		timing = shadowStageTimings[stageName]
+		lines.append('  {0:>30}  {1:6} calls  {2:8.3f} seconds  {3:8.2f} ms/call'.format(stageName, timing['calls'], timing['seconds'], 1000.0 * timing['seconds'] / timing['calls']))
+	log.info('\n'.join(lines))
+	
+	try:
+		with open(shadowWritesFilename, 'a') as writesFile:
+			for write in shadowRecordedWrites:
+				writesFile.write(json.dumps(write) + '\n')
+		del shadowRecordedWrites[:]
+	except:
+		# Do not vulgarly error out over a report we could not write.
+		e = str(sys.exc_info()[0])
+		l = str(sys.exc_traceback.tb_lineno)
+		log.error('Error when attempting to write shadow writes on line number {0}.  Exception:  {1}'.format(l, e))
+		logException()
+		pass
+
+@shadowTimedStage('processing cycle')
+def processCycle():
+	global cycleInProgress
+	
+	cycleInProgress = True
+	try:
+		if workerModeEnabled:
+			renewWorkerLeases()
 			
 		processModMail()
 		
 		if requestTrackerAllowModmailRepliesToBeSentToReddit:
 			processRequestTrackerRepliesToModMail()
+	finally:
+		cycleInProgress = False
+
+def mainloop():
+	cycleNumber = 0
+	
+	while True:
+		cycleNumber += 1
+		log.debug('Waking... Processing modmail.')
+		
+		if profileEveryNthCycle > 0 and cycleNumber % profileEveryNthCycle == 0:
+			profileProcessingCycle(cycleNumber)
+		else:
+			processCycle()
+		
+		reportSampledHotFunctionsIfDue()
+		
+		if shadowModeEnabled:
+			reportShadowRun()
 		
 		log.debug('Modmail processed.  Sleeping...')
 			
@@ -731,5 +1500,21 @@ if __name__ == '__main__':
 	if debug:
 		log_level = logging.DEBUG
 	setupLogger(log_level=log_level, log_file=args.logfile)
+	if args.worker_id:
+		workerId = args.worker_id
+	listingRecordFilename = args.record_listing
+	listingReplayFilename = args.replay_listing
+	listingReplaySpeed = args.replay_speed
+	if args.compact and (args.shadow or args.replay_listing):
+		arg_parser.error('--compact cannot be combined with shadow mode')
+	if args.shadow or args.replay_listing:
+		setupShadowMode(args.shadow_fresh_state)
 	init()
-	mainloop()
+	if args.compact:
+		compactHandledTickets()
+	elif args.replay_listing:
+		processModMail()
+		reportShadowRun()
+	else:
+		setupProfiling(args.logfile, args.profile_cycles, args.profile_sampling)
+		mainloop()